@@ -1,14 +1,22 @@
-from flask import Flask, render_template, redirect, request, url_for, flash
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, render_template, redirect, request, url_for, flash, g, make_response
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from datetime import date
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, Text, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, SmallInteger, select, String, Text, Date, DateTime, LargeBinary, ForeignKey, event, delete, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, joinedload, load_only
+from sqlalchemy.exc import IntegrityError
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
 from flask_gravatar import Gravatar
+from flask_caching import Cache
 from functools import wraps
 from flask import abort
 
@@ -16,32 +24,101 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = '8BYkEfBA6O6donzWlSihBXox7C0sKR6b'
 ckeditor = CKEditor(app)
 Bootstrap(app)
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
 
 # CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # dev SQLite: let pooled connections hop threads, and use WAL so
+    # readers don't block behind writers
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'connect_args': {'check_same_thread': False},
+    }
+
+    @event.listens_for(Engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+else:
+    # real Postgres/MySQL deployment: reuse connections across requests
+    # instead of paying the handshake per request, and drop stale ones
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 10,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True,
+    }
+
 db = SQLAlchemy(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
+# send anonymous users hitting @login_required pages to the login form
+# instead of a bare 401
+login_manager.login_view = 'login'
+
+# registers the 'gravatar' Jinja filter once at import, so routes don't rebuild it per request
+gravatar = Gravatar(app,
+                    size=100,
+                    rating='g',
+                    default='retro',
+                    force_default=False,
+                    force_lower=False,
+                    use_ssl=False,
+                    base_url=None)
+
+
+@app.template_filter('strftime')
+def format_date(value, fmt="%B %d, %Y"):
+    return value.strftime(fmt) if value else ""
+
+
+@app.after_request
+def revalidate_etag(response):
+    # turn any ETagged response into a 304 when the client's copy is
+    # current; runs after the view cache so cached hits revalidate too
+    if response.get_etag()[0] is not None:
+        return response.make_conditional(request)
+    return response
+
+
+# admin policy lives in one place; membership is an O(1) frozenset lookup
+ADMIN_IDS = frozenset({1})
+
+
+@app.context_processor
+def inject_is_admin():
+    # templates gate the edit/delete/new-post links on the same policy
+    # the admin_only decorator enforces
+    return dict(is_admin=current_user.is_authenticated and current_user.id in ADMIN_IDS)
 
 
 # create admin_only decorator
 def admin_only(function):
     @wraps(function)
     def decorated_function(*args, **kwargs):
-        # if id is not 1 then return abort with 403 error
-        if current_user.id != 1:
+        # the is_authenticated guard keeps anonymous users from blowing up
+        # on .id (AnonymousUserMixin has no id attribute)
+        if not current_user.is_authenticated or current_user.id not in ADMIN_IDS:
             return abort(403)
         # otherwise continue with the route function / authorized admin
-        else:
-            return function(*args, **kwargs)
+        return function(*args, **kwargs)
     return decorated_function
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # cache the user on flask.g so repeated loads within one request
+    # (templates touch current_user in every view) hit no extra queries
+    user = getattr(g, "_cached_user", None)
+    if user is None or user.id != int(user_id):
+        user = User.query.get(int(user_id))
+        g._cached_user = user
+    return user
 
 
 # CONFIGURE TABLES
@@ -49,7 +126,11 @@ class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, autoincrement=True)
     email = Column(String(100), unique=True, nullable=False)
+    # legacy Werkzeug hash string; emptied once the row is upgraded to the
+    # binary salt+digest pair below
     password = Column(String(100), nullable=False)
+    password_salt = Column(LargeBinary(8))
+    password_hash = Column(LargeBinary(32))
     name = Column(String(1000), nullable=False)
 
     # this will act like a list of BlogPost objects attached to each other
@@ -68,7 +149,7 @@ class BlogPost(db.Model):
     id = Column(Integer, primary_key=True)
 
     # create foreign key, "users.id" the users refers to the tablename of user
-    author_id = db.Column(Integer, ForeignKey('users.id'))
+    author_id = db.Column(SmallInteger, ForeignKey('users.id'), nullable=False, index=True)
 
     # create reference to the user object, the 'posts' refers to the posts' property in the User class
     author = relationship("User", back_populates="posts")
@@ -78,23 +159,35 @@ class BlogPost(db.Model):
 
     title = Column(String(250), unique=True, nullable=False)
     subtitle = Column(String(250), nullable=False)
-    date = Column(String(250), nullable=False)
+    # a real Date (not a pre-formatted string) so it sorts and indexes properly;
+    # display formatting lives in the 'strftime' template filter
+    date = Column(Date, nullable=False, index=True)
     body = Column(Text, nullable=False)
     img_url = Column(String(250), nullable=False)
 
+    # last-change timestamp, feeds cache invalidation / conditional GETs
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    # composite index so show_post's per-post lookup is a B-tree seek and
+    # chronological (ORDER BY id) reads stay index-only
+    __table_args__ = (db.Index('ix_comments_post_created', 'blog_post_id', 'id'),)
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     text = Column(Text, nullable=False)
 
+    # last-change timestamp, feeds the post page's ETag
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
     # create foreign key, "users.id" the users refers to the tablename of User
-    commenter_id = db.Column(Integer, ForeignKey('users.id'))
+    commenter_id = db.Column(SmallInteger, ForeignKey('users.id'), nullable=False, index=True)
     # create reference to the user object, the 'comments' refers to the comments' property in the user class
     commenter = relationship("User", back_populates="comments")
 
     # create foreign key, "blog_posts.id" the blog_posts refers to the tablename of BlogPost
-    blog_post_id = db.Column(Integer, ForeignKey('blog_posts.id'))
+    blog_post_id = db.Column(SmallInteger, ForeignKey('blog_posts.id'), nullable=False)
     # create reference to the BlogPost object, the '...' refers to the .... property in the BlogPost class
     blog_comment = relationship("BlogPost", back_populates="comments")
 
@@ -106,16 +199,74 @@ class Comment(db.Model):
 
 # db.create_all()
 
-users = {}
-all_users = db.session.query(User).with_entities(User.email).all()
-for user in all_users:
-    users[user.email] = {'password': 'Secret'}
+# OWASP-recommended pbkdf2 iteration count
+PBKDF2_ITERATIONS = 600000
+
+# reject absurd password lengths before burning a pbkdf2 derivation on them;
+# branching on length (not content) doesn't reopen the timing side channel
+MAX_PASSWORD_LENGTH = 1024
+
+# derived against when the email is unknown, so failed logins cost the same
+# pbkdf2 work (and take the same code path) whether or not the account exists;
+# generated once at import, never regenerated per request
+_DUMMY_SALT = os.urandom(8)
+_DUMMY_DIGEST = hashlib.pbkdf2_hmac('sha256', os.urandom(16), _DUMMY_SALT, PBKDF2_ITERATIONS)
+
+# pbkdf2 releases the GIL inside OpenSSL, so routing derivations through a small
+# pool lets a threaded worker keep serving other requests during the hash burn
+# and bounds how many concurrent verifies a login flood can pin on the CPU
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def derive_password_hash(password, salt):
+    return _HASH_POOL.submit(
+        hashlib.pbkdf2_hmac, 'sha256', password.encode(), salt, PBKDF2_ITERATIONS).result()
+
+
+def verify_password(user, password):
+    """Constant-time verify against the stored digest.
+
+    Binary salt+digest rows skip Werkzeug's per-verify string parsing and
+    compare raw bytes with hmac.compare_digest; rows still carrying a legacy
+    Werkzeug hash string are verified the old way and upgraded in place on
+    the first successful login.
+    """
+    if user is None:
+        # burn the same derivation cost for unknown emails, then fail
+        hmac.compare_digest(derive_password_hash(password, _DUMMY_SALT), _DUMMY_DIGEST)
+        return False
+    if user.password_hash is not None:
+        actual = derive_password_hash(password, user.password_salt)
+        return hmac.compare_digest(actual, user.password_hash)
+    # legacy Werkzeug-format hash
+    if not _HASH_POOL.submit(check_password_hash, user.password, password).result():
+        return False
+    user.password_salt = os.urandom(8)
+    user.password_hash = derive_password_hash(password, user.password_salt)
+    user.password = ""
+    db.session.commit()
+    return True
 
 
 @app.route('/')
+@cache.cached(timeout=60, key_prefix='index_page',
+              unless=lambda: current_user.is_authenticated,
+              response_filter=lambda resp: getattr(resp, 'status_code', 200) == 200)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts, current_user=current_user)
+    # Core select of just the rendered columns: one query, lightweight Row
+    # tuples, no ORM instrumentation or identity-map bookkeeping per post
+    stmt = (select(BlogPost.id, BlogPost.title, BlogPost.subtitle, BlogPost.date,
+                   BlogPost.updated_at, User.name.label('author_name'))
+            .join(User, BlogPost.author_id == User.id)
+            .order_by(BlogPost.id))
+    posts = db.session.execute(stmt).all()
+    response = make_response(render_template("index.html", all_posts=posts))
+    # browsers/proxies revalidate with If-None-Match and get a bodiless 304
+    # while nothing changed; auth state is part of the tag since the navbar differs
+    latest = max((p.updated_at for p in posts if p.updated_at), default=None)
+    etag_key = f"{current_user.get_id()}:{len(posts)}:{latest}"
+    response.set_etag(hashlib.md5(etag_key.encode()).hexdigest())
+    return response
 
 
 @app.route('/register', methods=["POST", "GET"])
@@ -123,28 +274,37 @@ def register():
     form = RegisterForm()
 
     if request.method == "POST" and form.validate_on_submit():
-        if request.form.get("email") in users:
+        password = request.form.get("password")
+        if not password or len(password) > MAX_PASSWORD_LENGTH:
+            flash("That password is too long, please pick a shorter one")
+            return redirect(url_for('register'))
+
+        # email is unique-indexed, so this existence check is a single index lookup
+        if db.session.query(User.id).filter_by(email=request.form.get("email")).first() is not None:
             flash("You've already signed up with that email, log in instead!")
-            form = LoginForm()
-            return redirect(url_for('login', form=form))
+            return redirect(url_for('login'))
 
-        hash_and_salted_password = generate_password_hash(
-            password=request.form.get("password"),
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
         new_user = User(
             email=request.form.get("email"),
-            password=hash_and_salted_password,
+            password="",
             name=request.form.get("name")
         )
-        db.session.add(new_user)
-        db.session.commit()
-
-        # login and authenticate user after adding details to database
-        login_user(new_user)
+        new_user.password_salt = os.urandom(8)
+        new_user.password_hash = derive_password_hash(password, new_user.password_salt)
+        try:
+            db.session.add(new_user)
+            db.session.flush()  # populate new_user.id without a commit
+            # login and authenticate user after adding details to database
+            login_user(new_user)
+            db.session.commit()  # single durable write for the whole flow
+        except IntegrityError:
+            # two concurrent registrations can pass the existence check;
+            # the unique index on email catches the loser here
+            db.session.rollback()
+            flash("You've already signed up with that email, log in instead!")
+            return redirect(url_for('login'))
 
-        return redirect(url_for('get_all_posts', current_user=current_user))
+        return redirect(url_for('get_all_posts'))
 
     return render_template("register.html", form=form)
 
@@ -155,22 +315,21 @@ def login():
     if request.method == "POST" and form.validate_on_submit():
         email = request.form["email"]
         password = request.form["password"]
-        # email does not exist in user database table
-        if email not in users:
-            flash("The username/email does not exist!")
-            return redirect(url_for('login', form=form))
+        if not password or len(password) > MAX_PASSWORD_LENGTH:
+            flash("The email or password is incorrect, Please try again")
+            return redirect(url_for('login'))
+        # find user by email entered
+        new_user = User.query.filter_by(email=email).first()
+        # check stored password hash against entered password hashed; a dummy
+        # derivation runs for unknown emails so timing doesn't reveal whether
+        # the account exists (compare_digest happens inside)
+        if verify_password(new_user, password):
+            # login and authenticate user after adding details to database
+            login_user(new_user)
+            return redirect(url_for('get_all_posts'))
         else:
-            # find user by email entered
-            new_user = User.query.filter_by(email=email).first()
-            # check stored password hash against entered password hashed
-            if new_user and check_password_hash(pwhash=new_user.password, password=password):
-                # login and authenticate user after adding details to database
-                login_user(new_user)
-                print(current_user.id)
-                return redirect(url_for('get_all_posts', current_user=current_user))
-            else:
-                flash("The password is incorrect, Please try again")
-                return redirect(url_for('login', form=form))
+            flash("The email or password is incorrect, Please try again")
+            return redirect(url_for('login'))
     else:
         return render_template("login.html", form=form)
 
@@ -178,24 +337,24 @@ def login():
 @app.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('get_all_posts', current_user=current_user))
+    return redirect(url_for('get_all_posts'))
 
 
 @app.route("/post/<int:post_id>", methods=["POST", "GET"])
 def show_post(post_id):
     form = CommentForm()
-    requested_post = BlogPost.query.get(post_id)
-
-    all_comments = db.session.query(Comment).filter_by(blog_post_id=post_id).all()
-
-    gravatar = Gravatar(app,
-                        size=100,
-                        rating='g',
-                        default='retro',
-                        force_default=False,
-                        force_lower=False,
-                        use_ssl=False,
-                        base_url=None)
+    # 404 on a missing id instead of rendering None and 500-ing; the post
+    # itself stays ORM-loaded (the comment POST path reuses the session)
+    requested_post = BlogPost.query.options(joinedload(BlogPost.author)).get_or_404(post_id)
+
+    # Core select of just the rendered columns; one query, no ORM hydration
+    comment_stmt = (select(Comment.text, Comment.updated_at,
+                           User.email.label('commenter_email'),
+                           User.name.label('commenter_name'))
+                    .join(User, Comment.commenter_id == User.id)
+                    .where(Comment.blog_post_id == post_id)
+                    .order_by(Comment.id))
+    all_comments = db.session.execute(comment_stmt).all()
 
     if request.method == "POST":
         if form.validate_on_submit() and current_user.is_authenticated:
@@ -213,17 +372,24 @@ def show_post(post_id):
             flash("You need to login or register to comment")
             return redirect(url_for('login'))
 
-    return render_template("post.html", post=requested_post, comments=all_comments, gravatar=gravatar, form=form, current_user=current_user)
+    response = make_response(
+        render_template("post.html", post=requested_post, comments=all_comments, form=form))
+    # same conditional-GET treatment as the index: 304 while the post and
+    # its comments are unchanged for this auth state
+    latest_comment = max((c.updated_at for c in all_comments if c.updated_at), default=None)
+    etag_key = f"{current_user.get_id()}:{requested_post.id}:{requested_post.updated_at}:{len(all_comments)}:{latest_comment}"
+    response.set_etag(hashlib.md5(etag_key.encode()).hexdigest())
+    return response
 
 
 @app.route("/about")
 def about():
-    return render_template("about.html", current_user=current_user)
+    return render_template("about.html")
 
 
 @app.route("/contact")
 def contact():
-    return render_template("contact.html", current_user=current_user)
+    return render_template("contact.html")
 
 
 @app.route("/new-post", methods=["POST", "GET"])
@@ -238,20 +404,24 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
         db.session.add(new_post)
         db.session.commit()
+        cache.delete('index_page')
         return redirect(url_for("get_all_posts"))
 
-    return render_template("make-post.html", form=form, current_user=current_user)
+    return render_template("make-post.html", form=form)
 
 
 @app.route("/edit-post/<int:post_id>", methods=["POST", "GET"])
-@admin_only
 @login_required
+@admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    # only the columns the form needs, skipping the rest of the row
+    post = (BlogPost.query
+            .options(load_only(BlogPost.title, BlogPost.subtitle, BlogPost.img_url, BlogPost.body))
+            .get_or_404(post_id))
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -266,17 +436,22 @@ def edit_post(post_id):
         # post.author = edit_form.author.data
         post.body = edit_form.body.data
         db.session.commit()
+        cache.delete('index_page')
         return redirect(url_for("show_post", post_id=post.id))
 
-    return render_template("make-post.html", form=edit_form, is_edit=True, current_user=current_user)
+    return render_template("make-post.html", form=edit_form, is_edit=True)
 
 
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
-    db.session.delete(post_to_delete)
+    # no need to hydrate the full row (including the Text body) just to delete
+    # it; the comments go first in the same transaction, since the Core delete
+    # bypasses the ORM's relationship handling and the FK is NOT NULL
+    db.session.execute(delete(Comment).where(Comment.blog_post_id == post_id))
+    db.session.execute(delete(BlogPost).where(BlogPost.id == post_id))
     db.session.commit()
+    cache.delete('index_page')
     return redirect(url_for('get_all_posts'))
 
 